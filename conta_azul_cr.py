@@ -1,19 +1,35 @@
+import functools
 import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from calendar import monthrange
+from urllib.parse import quote, urlencode
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
 import json
 import time
 
 
+FETCH_WORKERS = 6
+
+
 class ContaAzulClient:
     """Simple client for Conta Azul API."""
 
     def __init__(self, token: str, base_url: str = "https://api.contaazul.com"):
         self.token = token
         self.base_url = base_url.rstrip("/")
+        # shared across the monthly fetch threads so connections are reused
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(
+            pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS, max_retries=retry
+        )
+        self.session.mount("https://", adapter)
 
     def search_installments(self, vencimento_de: str, vencimento_ate: str):
         """Fetch installments to receive using date filter."""
@@ -22,8 +38,7 @@ class ContaAzulClient:
             "data_vencimento_de": vencimento_de,
             "data_vencimento_ate": vencimento_ate,
         }
-        headers = {"Authorization": f"Bearer {self.token}"}
-        response = requests.get(url, params=params, headers=headers, timeout=30)
+        response = self.session.get(url, params=params, timeout=30)
         response.raise_for_status()
         data = response.json()
         # the API may wrap results inside 'data'
@@ -34,6 +49,10 @@ class ContaAzulClient:
 
 AUTH_URL = "https://auth.contaazul.com/oauth2/authorize"
 TOKEN_URL = "https://auth.contaazul.com/oauth2/token"
+# refresh tokens slightly before they expire to avoid racing the deadline
+TOKEN_EXPIRY_MARGIN = 60
+INSERT_ROWS_PER_STATEMENT = 100
+SQLITE_MAX_VARIABLES = 999
 
 
 class OAuthHandler:
@@ -44,6 +63,7 @@ class OAuthHandler:
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
         self.token_file = token_file
+        self._tokens: dict | None = None
 
     def _basic_auth_header(self) -> dict:
         cred = f"{self.client_id}:{self.client_secret}".encode()
@@ -59,6 +79,29 @@ class OAuthHandler:
     def save_tokens(self, tokens: dict) -> None:
         with open(self.token_file, "w", encoding="utf-8") as fh:
             json.dump(tokens, fh)
+        self._tokens = tokens
+
+    def get_access_token(self) -> str:
+        """Return a valid access token, touching disk or the API only when needed."""
+        if self._tokens is None:
+            self._tokens = self.load_tokens()
+
+        tokens = self._tokens
+        if tokens:
+            if tokens.get("expires_at", 0) - TOKEN_EXPIRY_MARGIN > time.time():
+                return tokens["access_token"]
+            if tokens.get("refresh_token"):
+                tokens = self.refresh(tokens["refresh_token"])
+                return tokens["access_token"]
+
+        code = os.environ.get("CONTA_AZUL_AUTH_CODE")
+        if not code:
+            url = self.authorization_url()
+            raise SystemExit(f"Defina CONTA_AZUL_AUTH_CODE com o codigo obtido em: {url}")
+
+        tokens = self.exchange_code(code)
+        os.environ.pop("CONTA_AZUL_AUTH_CODE", None)
+        return tokens["access_token"]
 
     def exchange_code(self, code: str) -> dict:
         data = {
@@ -101,8 +144,7 @@ class OAuthHandler:
             "state": state,
             "scope": "openid profile aws.cognito.signin.user.admin",
         }
-        query = "&".join(f"{k}={requests.utils.quote(v)}" for k, v in params.items())
-        return f"{AUTH_URL}?{query}"
+        return f"{AUTH_URL}?{urlencode(params, quote_via=quote)}"
 
 
 def month_range(year: int, month: int):
@@ -115,48 +157,63 @@ def month_range(year: int, month: int):
 
 def ensure_table(cursor: sqlite3.Cursor, sample_record: dict):
     """Create table CR with columns based on sample record if it does not exist."""
-    cursor.execute(
-        "SELECT name FROM sqlite_master WHERE type='table' AND name='CR'"
-    )
-    if cursor.fetchone():
-        return
-
     columns = ",".join(f"{key} TEXT" for key in sample_record.keys())
     cursor.execute(f"CREATE TABLE IF NOT EXISTS CR ({columns})")
 
 
-def insert_records(conn: sqlite3.Connection, records: list):
+def rows_per_statement(columns: tuple) -> int:
+    """Pack as many rows per INSERT as SQLite's bound-parameter limit allows."""
+    return max(1, min(INSERT_ROWS_PER_STATEMENT, SQLITE_MAX_VARIABLES // len(columns)))
+
+
+@functools.lru_cache(maxsize=32)
+def build_insert_sql(columns: tuple, n_rows: int) -> str:
+    """Build (once) a multi-row INSERT into CR for ``n_rows`` rows of ``columns``."""
+    placeholders = "(" + ",".join("?" for _ in columns) + ")"
+    return f"INSERT INTO CR ({','.join(columns)}) VALUES " + ",".join([placeholders] * n_rows)
+
+
+def insert_records(conn: sqlite3.Connection, columns: tuple, records: list):
+    """Insert the ``columns`` of each record into CR using chunked multi-row INSERTs."""
     if not records:
         return
     cursor = conn.cursor()
-    ensure_table(cursor, records[0])
-
-    existing_cols = [info[1] for info in cursor.execute("PRAGMA table_info(CR)")]
-    placeholders = ",".join("?" for _ in existing_cols)
-    insert_sql = f"INSERT INTO CR ({','.join(existing_cols)}) VALUES ({placeholders})"
-    for record in records:
-        values = [record.get(col) for col in existing_cols]
-        cursor.execute(insert_sql, values)
-    conn.commit()
+    chunk = rows_per_statement(columns)
+    insert_sql = build_insert_sql(columns, chunk)
+
+    values = [record.get(col) for record in records for col in columns]
+    step = chunk * len(columns)
+    full = len(records) // chunk * step
+    # a single transaction for the whole batch; rolled back if any chunk fails
+    with conn:
+        for start in range(0, full, step):
+            cursor.execute(insert_sql, values[start:start + step])
+        leftover = len(records) % chunk
+        if leftover:
+            cursor.execute(build_insert_sql(columns, leftover), values[full:])
+
+
+def prepare_schema(conn: sqlite3.Connection, sample_record: dict) -> tuple:
+    """Fix the CR schema for this run and return its columns."""
+    ensure_table(conn.cursor(), sample_record)
+    return tuple(info[1] for info in conn.execute("PRAGMA table_info(CR)"))
+
+
+def configure_connection(conn: sqlite3.Connection) -> None:
+    """Tune SQLite for the write-only monthly sync."""
+    conn.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA cache_size=-65536;"
+    )
+    # initial bulk loads can skip fsync entirely; the data can be refetched
+    if os.environ.get("CONTA_AZUL_SQLITE_BULK_LOAD") == "1":
+        conn.execute("PRAGMA synchronous=OFF")
 
 
 def get_access_token(auth: OAuthHandler) -> str:
-    tokens = auth.load_tokens()
-    if tokens:
-        if tokens.get("expires_at", 0) > time.time():
-            return tokens["access_token"]
-        if tokens.get("refresh_token"):
-            tokens = auth.refresh(tokens["refresh_token"])
-            return tokens["access_token"]
-
-    code = os.environ.get("CONTA_AZUL_AUTH_CODE")
-    if not code:
-        url = auth.authorization_url()
-        raise SystemExit(f"Defina CONTA_AZUL_AUTH_CODE com o codigo obtido em: {url}")
-
-    tokens = auth.exchange_code(code)
-    os.environ.pop("CONTA_AZUL_AUTH_CODE", None)
-    return tokens["access_token"]
+    return auth.get_access_token()
 
 
 def main(year: int):
@@ -172,12 +229,26 @@ def main(year: int):
     client = ContaAzulClient(token)
     db_path = "conta_azul.db"
     conn = sqlite3.connect(db_path)
+    configure_connection(conn)
 
     try:
-        for month in range(1, 13):
-            inicio, fim = month_range(year, month)
-            data = client.search_installments(inicio, fim)
-            insert_records(conn, data)
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            monthly_records = executor.map(
+                lambda month: client.search_installments(*month_range(year, month)),
+                range(1, 13),
+            )
+            columns = None
+            # results come back in calendar order so the schema is taken from the
+            # first non-empty month; SQLite writes stay on the main thread while
+            # later months are still downloading, and map() drops each month's
+            # records once they have been yielded
+            for records in monthly_records:
+                if not records:
+                    continue
+                if columns is None:
+                    # the schema is fixed for the rest of the run
+                    columns = prepare_schema(conn, records[0])
+                insert_records(conn, columns, records)
     finally:
         conn.close()
 
@@ -22,12 +22,18 @@ from __future__ import annotations
 
 import argparse
 import json
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import gspread
+from gspread.utils import absolute_range_name
 from google.oauth2.service_account import Credentials
 
 
@@ -40,6 +46,7 @@ CP_ENDPOINT = (
     "contas-a-pagar/buscar"
 )
 PAGE_SIZE = 100
+FETCH_WORKERS = 8
 SHEETS_SCOPE = "https://www.googleapis.com/auth/spreadsheets"
 
 
@@ -92,6 +99,12 @@ def parse_args() -> argparse.Namespace:
 def build_session(token: str | None, verify_ssl: bool) -> requests.Session:
     session = requests.Session()
     session.verify = verify_ssl
+    # pages are fetched concurrently, so back off on rate limits and 5xx
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(
+        pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS, max_retries=retry
+    )
+    session.mount("https://", adapter)
     if token:
         session.headers.update({"Authorization": f"Bearer {token}"})
     session.headers.setdefault("Accept", "application/json")
@@ -111,63 +124,96 @@ def build_sheets_client(service_account_file: str | None) -> gspread.Client:
     return gspread.authorize(credentials)
 
 
-def fetch_all(
+def fetch_page(
     session: requests.Session,
     endpoint: str,
     start: str,
     end: str,
-) -> list[dict[str, Any]]:
-    """Fetch all pages of financial events from the given endpoint."""
-
-    collected: list[dict[str, Any]] = []
-    total_expected: int | None = None
-    page = 1
-
-    while True:
-        params = {
-            "pagina": page,
-            "tamanho_pagina": PAGE_SIZE,
-            "data_vencimento_de": start,
-            "data_vencimento_ate": end,
-        }
-        response = session.get(endpoint, params=params, timeout=60)
-        response.raise_for_status()
-        payload = response.json()
+    page: int,
+) -> tuple[list[dict[str, Any]], int]:
+    """Fetch a single page and return its items with the reported total."""
 
-        if not isinstance(payload, dict):
-            raise ApiError("Resposta inesperada: objeto JSON deve ser um dicionário")
+    params = {
+        "pagina": page,
+        "tamanho_pagina": PAGE_SIZE,
+        "data_vencimento_de": start,
+        "data_vencimento_ate": end,
+    }
+    response = session.get(endpoint, params=params, timeout=60)
+    response.raise_for_status()
+    payload = response.json()
 
-        if "itens" not in payload:
-            raise ApiError("Resposta inesperada: campo 'itens' ausente")
-        if "itens_totais" not in payload:
-            raise ApiError("Resposta inesperada: campo 'itens_totais' ausente")
+    if not isinstance(payload, dict):
+        raise ApiError("Resposta inesperada: objeto JSON deve ser um dicionário")
 
-        items = payload["itens"]
-        if not isinstance(items, list):
-            raise ApiError("Campo 'itens' deve ser uma lista")
+    if "itens" not in payload:
+        raise ApiError("Resposta inesperada: campo 'itens' ausente")
+    if "itens_totais" not in payload:
+        raise ApiError("Resposta inesperada: campo 'itens_totais' ausente")
 
-        total = int(payload["itens_totais"])
-        if total_expected is None:
-            total_expected = total
+    items = payload["itens"]
+    if not isinstance(items, list):
+        raise ApiError("Campo 'itens' deve ser uma lista")
 
-        for item in items:
-            if not isinstance(item, dict):
-                raise ApiError("Cada item retornado deve ser um objeto JSON")
-            collected.append(item)
+    if not all(type(item) is dict for item in items):
+        raise ApiError("Cada item retornado deve ser um objeto JSON")
 
-        if len(collected) >= total_expected or not items:
-            break
+    return items, int(payload["itens_totais"])
+
+
+def fetch_all(
+    session: requests.Session,
+    endpoint: str,
+    start: str,
+    end: str,
+) -> list[dict[str, Any]]:
+    """Fetch all pages of financial events from the given endpoint.
+
+    The first page is requested alone to learn the total number of items and
+    the page size the server actually uses; the remaining pages are then
+    fetched concurrently. If that still falls short of the reported total,
+    further pages are requested one by one until an empty page is returned.
+    """
+
+    collected, total_expected = fetch_page(session, endpoint, start, end, 1)
+    if not collected or len(collected) >= total_expected:
+        return collected
+
+    # the server may cap tamanho_pagina, so size pages from what it returned
+    n_pages = math.ceil(total_expected / len(collected))
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        # map() yields results in page order
+        pages = executor.map(
+            lambda page: fetch_page(session, endpoint, start, end, page)[0],
+            range(2, n_pages + 1),
+        )
+        for items in pages:
+            collected.extend(items)
 
+    page = n_pages + 1
+    while len(collected) < total_expected:
+        items, _ = fetch_page(session, endpoint, start, end, page)
+        if not items:
+            break
+        collected.extend(items)
         page += 1
 
     return collected
 
 
+def dumps_json(value: Any) -> str:
+    try:
+        return orjson.dumps(value).decode()
+    except orjson.JSONEncodeError:
+        # e.g. integers wider than 64 bits, which the stdlib still encodes
+        return json.dumps(value, ensure_ascii=False)
+
+
 def normalise_value(value: Any) -> Any:
     if value is None:
         return ""
     if isinstance(value, (dict, list)):
-        return json.dumps(value, ensure_ascii=False)
+        return dumps_json(value)
     return value
 
 
@@ -176,31 +222,55 @@ def ensure_worksheet(spreadsheet: gspread.Spreadsheet, name: str) -> gspread.Wor
         worksheet = spreadsheet.worksheet(name)
     except gspread.WorksheetNotFound:
         worksheet = spreadsheet.add_worksheet(title=name, rows=1, cols=1)
-    worksheet.clear()
     return worksheet
 
 
 def records_to_rows(records: list[dict[str, Any]]) -> list[list[Any]]:
-    columns: list[str] = []
+    # dict keys keep insertion order, so this dedups while preserving first-seen order
+    col_index: dict[str, int] = {}
     for record in records:
-        for key in record.keys():
-            if key not in columns:
-                columns.append(key)
+        for key in record:
+            if key not in col_index:
+                col_index[key] = len(col_index)
+    columns = list(col_index)
 
     if not columns:
-        return [["raw_json"], *([[json.dumps(record, ensure_ascii=False)] for record in records])]
+        return [["raw_json"], *([[dumps_json(record)] for record in records])]
 
-    rows = [[normalise_value(record.get(column)) for column in columns] for record in records]
+    rows: list[list[Any]] = []
+    for record in records:
+        # missing keys stay as "" (normalise_value(None))
+        row: list[Any] = [""] * len(columns)
+        for key, value in record.items():
+            row[col_index[key]] = normalise_value(value)
+        rows.append(row)
     return [columns, *rows]
 
 
-def write_to_sheet(worksheet: gspread.Worksheet, records: list[dict[str, Any]]) -> None:
-    if not records:
+def write_to_sheets(
+    spreadsheet: gspread.Spreadsheet,
+    contents: list[tuple[gspread.Worksheet, list[dict[str, Any]]]],
+) -> None:
+    """Replace the contents of each worksheet using two batched API calls."""
+
+    spreadsheet.values_batch_clear(
+        body={"ranges": [absolute_range_name(worksheet.title) for worksheet, _ in contents]}
+    )
+
+    data = [
+        {
+            "range": absolute_range_name(worksheet.title, "A1"),
+            "values": records_to_rows(records),
+        }
+        for worksheet, records in contents
         # Aba deve permanecer vazia após clear
+        if records
+    ]
+    if not data:
         return
 
-    values = records_to_rows(records)
-    worksheet.update("A1", values)
+    # RAW skips Sheets' server-side parsing of numbers, dates and formulas
+    spreadsheet.values_batch_update(body={"valueInputOption": "RAW", "data": data})
 
 
 def main() -> None:
@@ -225,8 +295,10 @@ def main() -> None:
     contas_receber = fetch_all(session, CR_ENDPOINT, args.start, args.end)
     contas_pagar = fetch_all(session, CP_ENDPOINT, args.start, args.end)
 
-    write_to_sheet(worksheet_cr, contas_receber)
-    write_to_sheet(worksheet_cp, contas_pagar)
+    write_to_sheets(
+        spreadsheet,
+        [(worksheet_cr, contas_receber), (worksheet_cp, contas_pagar)],
+    )
 
 
 if __name__ == "__main__":
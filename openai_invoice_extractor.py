@@ -6,64 +6,99 @@ latest OpenAI Chat Completions endpoint.
 """
 from __future__ import annotations
 
+import functools
 import json
 import os
 import re
-from typing import Any, Dict, Optional
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
 
+import orjson
 import requests
-import tiktoken
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+if TYPE_CHECKING:
+    import tiktoken
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# Upper bound on concurrent batch requests; 429s are still possible and are
+# retried with backoff by the batch session.
+MAX_CONCURRENT_REQUESTS = 8
+# Output budget for the JSON answer; the prompt is tokenised server-side only.
+# Invoices with many line items produce long answers, and a budget that is too
+# small truncates the JSON, so this is kept generous. It suits the default
+# gpt-5 model; models with a lower output limit reject requests above it, so
+# pass a smaller max_tokens when choosing one of those.
+MAX_OUTPUT_TOKENS = 16384
 
 
 class OpenAIAPIError(RuntimeError):
     """Raised when the OpenAI API returns an error response."""
 
 
+@functools.lru_cache(maxsize=8)
+def _get_encoding(encoding_name: str) -> tiktoken.Encoding:
+    """Load a tiktoken encoding once and reuse it across calls."""
+    # tiktoken is only needed by the token-counting helpers
+    import tiktoken
+
+    return tiktoken.get_encoding(encoding_name)
+
+
 def num_tokens_from_string(string: str, encoding_name: str) -> int:
     """Return the number of tokens in a text string for a given encoding."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    return len(encoding.encode(string))
+    return len(_get_encoding(encoding_name).encode(string))
+
+
+def num_tokens_from_strings(strings: List[str], encoding_name: str) -> List[int]:
+    """Return the number of tokens of each string, encoding them in parallel."""
+    encoded = _get_encoding(encoding_name).encode_batch(strings, num_threads=os.cpu_count() or 1)
+    return [len(tokens) for tokens in encoded]
 
 
 def clean_text(raw_text: str) -> str:
     """Collapse whitespace so the prompt stays compact."""
-    return re.sub(r"\s+", " ", raw_text).strip()
+    return _WHITESPACE_RE.sub(" ", raw_text).strip()
+
+
+_PROMPT_INSTRUCTIONS = (
+    ' *** Extraía apenas dos arquivos PDF enviados agora nessa mensagem, '
+    "os itens da tabela que contem as informações Item, Quantity, Rate e Amount. "
+    "Extraía cada linha e formate os dados da seguinte forma: 0 - A coluna \"Item\" "
+    'tem duas linhas extraia a primeira linha é referente ao conteúdo do JSON "Item" '
+    'e a segunda linha possui duas datas a primeira data deve ser extraída e atribuida '
+    'ao conteúdo do JSON "dataStart" e a segunda data deve ser extraída e atribuida '
+    'ao conteúdo do JSON "dataEnd" 1 - Deve ser removido o item da tabela que contenha '
+    'o texto Usage na coluna "Item" 2 - A coluna Item possui duas linhas, sendo assim quero '
+    'extraia apenas a primeira linha 3 - A coluna Rate precisa ser convertida em numérica '
+    'com duas casas decimais, usando o carácter . como separador decimal 4 - A coluna Amount, '
+    'deve apenas conte números e convertida em numérica com duas casas decimais, usando o '
+    'carácter . como separador decimal. O caracter vírgula deve ser removido Na coluna '
+    'Quantity, Rate e Amount, se possuirem casa decimal maior que 2, deve ser mantido o '
+    'total das casas decimais extraídas. Além disso, deve ser extraída a informação que vem '
+    'após o texto “Invoice #“ que é o número da invoice e também a informação "Amount Due" '
+    'que fica no fim do arquivo e que deve apenas conte números e convertida em numérica '
+    'com duas casas decimais, usando o carácter . como separador decimal. O caracter vírgula '
+    'deve ser removido. Você deve gerar uma saída com esses dados extraídos em um formato '
+    'json, onde os itens extraídos são ramificações filha de uma propriedade chamada '
+    '“invoice” e o conteúdo é o número da invoice e também a informação "Amount Due" deve '
+    'vir depois da informação do número da invoice, alem disso o número da invoice possui '
+    'um separador de traço -, você deve extrair a primeira parte do traço que atribuida a '
+    'propriedade o JSON datadogId. Use o JSON a seguir como modelo: '
+    '{ "invoices": [ { "invoice": "1200082703-10112023",  "datadogId": "1200082703",  "amountDue": 10.20, '
+    '"items": [ { "Item": "On-Demand Analyzed Logs (Security)", "dataStart": 2024-01-01, "dataEnd": 2024-01-31, '
+    '"Quantity": 305, "Rate": 0.29, "Amount": 88.76 } ] }, ] } Quero que sua resposta apenas '
+    'contenha o JSON e mais nenhum outro tipo de informação, caso o texto enviado não tenha '
+    'dados a serem extraidos retorne o JSON com items vazio.'
+)
 
 
 def build_prompt(clean_text_value: str) -> str:
     """Compose the prompt required by the automation."""
-    return (
-        "*** "
-        + clean_text_value
-        + ' *** Extraía apenas dos arquivos PDF enviados agora nessa mensagem, '
-        + "os itens da tabela que contem as informações Item, Quantity, Rate e Amount. "
-        + "Extraía cada linha e formate os dados da seguinte forma: 0 - A coluna \"Item\" "
-        + 'tem duas linhas extraia a primeira linha é referente ao conteúdo do JSON "Item" '
-        + 'e a segunda linha possui duas datas a primeira data deve ser extraída e atribuida '
-        + 'ao conteúdo do JSON "dataStart" e a segunda data deve ser extraída e atribuida '
-        + 'ao conteúdo do JSON "dataEnd" 1 - Deve ser removido o item da tabela que contenha '
-        + 'o texto Usage na coluna "Item" 2 - A coluna Item possui duas linhas, sendo assim quero '
-        + 'extraia apenas a primeira linha 3 - A coluna Rate precisa ser convertida em numérica '
-        + 'com duas casas decimais, usando o carácter . como separador decimal 4 - A coluna Amount, '
-        + 'deve apenas conte números e convertida em numérica com duas casas decimais, usando o '
-        + 'carácter . como separador decimal. O caracter vírgula deve ser removido Na coluna '
-        + 'Quantity, Rate e Amount, se possuirem casa decimal maior que 2, deve ser mantido o '
-        + 'total das casas decimais extraídas. Além disso, deve ser extraída a informação que vem '
-        + 'após o texto “Invoice #“ que é o número da invoice e também a informação "Amount Due" '
-        + 'que fica no fim do arquivo e que deve apenas conte números e convertida em numérica '
-        + 'com duas casas decimais, usando o carácter . como separador decimal. O caracter vírgula '
-        + 'deve ser removido. Você deve gerar uma saída com esses dados extraídos em um formato '
-        + 'json, onde os itens extraídos são ramificações filha de uma propriedade chamada '
-        + '“invoice” e o conteúdo é o número da invoice e também a informação "Amount Due" deve '
-        + 'vir depois da informação do número da invoice, alem disso o número da invoice possui '
-        + 'um separador de traço -, você deve extrair a primeira parte do traço que atribuida a '
-        + 'propriedade o JSON datadogId. Use o JSON a seguir como modelo: '
-        + '{ "invoices": [ { "invoice": "1200082703-10112023",  "datadogId": "1200082703",  "amountDue": 10.20, '
-        + '"items": [ { "Item": "On-Demand Analyzed Logs (Security)", "dataStart": 2024-01-01, "dataEnd": 2024-01-31, '
-        + '"Quantity": 305, "Rate": 0.29, "Amount": 88.76 } ] }, ] } Quero que sua resposta apenas '
-        + 'contenha o JSON e mais nenhum outro tipo de informação, caso o texto enviado não tenha '
-        + 'dados a serem extraidos retorne o JSON com items vazio.'
-    )
+    return f"*** {clean_text_value}{_PROMPT_INSTRUCTIONS}"
 
 
 def query_custom_gpt(
@@ -73,6 +108,7 @@ def query_custom_gpt(
     tokens: int,
     *,
     timeout: int = 60,
+    session: Optional[requests.Session] = None,
 ) -> str:
     """Send a request to the Chat Completions endpoint and return raw JSON text."""
 
@@ -90,7 +126,8 @@ def query_custom_gpt(
         "response_format": {"type": "json_object"},
     }
 
-    response = requests.post(url, headers=headers, json=payload, timeout=timeout)
+    http = session or requests
+    response = http.post(url, headers=headers, json=payload, timeout=timeout)
     if response.status_code >= 500:
         raise OpenAIAPIError(
             f"Erro interno do servidor da OpenAI: {response.status_code} -> {response.text}"
@@ -111,7 +148,34 @@ def query_custom_gpt(
 def parse_json_response(raw_content: str) -> Dict[str, Any]:
     """Normalise the string returned by the model into a Python dictionary."""
     compact_json = "".join(line.strip() for line in raw_content.splitlines())
-    return json.loads(compact_json)
+    return orjson.loads(compact_json)
+
+
+def _resolve_api_key(api_key: Optional[str], encoding: Optional[str]) -> str:
+    """Shared argument handling for the public extraction helpers."""
+    if encoding is not None:
+        warnings.warn(
+            "O parâmetro 'encoding' é obsoleto e será removido; use max_tokens.",
+            DeprecationWarning,
+            stacklevel=3,
+        )
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("API key não fornecida. Defina OPENAI_API_KEY ou passe api_key explicitamente.")
+    return api_key
+
+
+def _extract(
+    raw_text: str,
+    api_key: str,
+    model_id: str,
+    max_tokens: int,
+    session: Optional[requests.Session] = None,
+) -> Dict[str, Any]:
+    """Run the prompt, request and parsing steps for a single document."""
+    prompt = build_prompt(clean_text(raw_text))
+    raw_content = query_custom_gpt(api_key, model_id, prompt, max_tokens, session=session)
+    return parse_json_response(raw_content)
 
 
 def run_extraction(
@@ -119,17 +183,71 @@ def run_extraction(
     *,
     api_key: Optional[str] = None,
     model_id: str = "gpt-5",
-    encoding: str = "cl100k_base",
+    max_tokens: int = MAX_OUTPUT_TOKENS,
+    encoding: Optional[str] = None,
 ) -> Dict[str, Any]:
-    """High level helper that orchestrates the full workflow."""
-    api_key = api_key or os.environ.get("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("API key não fornecida. Defina OPENAI_API_KEY ou passe api_key explicitamente.")
+    """High level helper that orchestrates the full workflow.
 
-    prompt = build_prompt(clean_text(raw_text))
-    tokens = num_tokens_from_string(prompt, encoding)
-    raw_content = query_custom_gpt(api_key, model_id, prompt, tokens)
-    return parse_json_response(raw_content)
+    ``max_tokens`` caps the size of the model's answer; if an invoice has more
+    items than fit in it the returned JSON is truncated and fails to parse, so
+    raise it for very large documents. ``encoding`` is deprecated and ignored.
+    """
+    api_key = _resolve_api_key(api_key, encoding)
+    return _extract(raw_text, api_key, model_id, max_tokens)
+
+
+def build_batch_session() -> requests.Session:
+    """Session shared by batch requests, retrying rate limits and server errors."""
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        # POST is not retried by default
+        allowed_methods=None,
+        # hand the last response back so query_custom_gpt reports it
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS, max_retries=retry
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+def run_extraction_batch(
+    raw_texts: List[str],
+    *,
+    api_key: Optional[str] = None,
+    model_id: str = "gpt-5",
+    max_tokens: int = MAX_OUTPUT_TOKENS,
+    encoding: Optional[str] = None,
+) -> List[Union[Dict[str, Any], Exception]]:
+    """Run the extraction for several documents concurrently.
+
+    Requests share a single HTTP session so connections are reused, and the
+    results are returned in the same order as ``raw_texts``. A document whose
+    extraction fails gets the raised exception in its slot instead of a
+    dictionary, so one bad invoice does not discard the others. ``max_tokens``
+    and the deprecated ``encoding`` behave as in :func:`run_extraction`.
+    """
+    api_key = _resolve_api_key(api_key, encoding)
+
+    results: Dict[int, Union[Dict[str, Any], Exception]] = {}
+    with build_batch_session() as session:
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            futures = {
+                executor.submit(_extract, raw_text, api_key, model_id, max_tokens, session): index
+                for index, raw_text in enumerate(raw_texts)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except (OpenAIAPIError, requests.RequestException, ValueError) as exc:
+                    results[index] = exc
+
+    return [results[index] for index in range(len(raw_texts))]
 
 
 if __name__ == "__main__":
@@ -143,12 +261,26 @@ if __name__ == "__main__":
     parser.add_argument(
         "--model",
         default="gpt-5",
-        help="Modelo a ser utilizado (padrão: gpt-5).",
+        help=(
+            "Modelo a ser utilizado (padrão: gpt-5). Modelos com limite de saída"
+            f" menor que {MAX_OUTPUT_TOKENS} tokens exigem também --max-tokens."
+        ),
+    )
+    parser.add_argument(
+        "--max-tokens",
+        dest="max_tokens",
+        type=int,
+        default=MAX_OUTPUT_TOKENS,
+        help=(
+            f"Limite de tokens da resposta (padrão: {MAX_OUTPUT_TOKENS}). Deve respeitar"
+            " o limite de saída do modelo escolhido em --model, senão a API recusa a"
+            " requisição."
+        ),
     )
     parser.add_argument(
         "--encoding",
-        default="cl100k_base",
-        help="Encoding do tiktoken usado para contar tokens (padrão: cl100k_base).",
+        default=None,
+        help="Obsoleto e ignorado; será removido. Use --max-tokens.",
     )
     parser.add_argument(
         "--api-key",
@@ -163,6 +295,7 @@ if __name__ == "__main__":
             args.texto,
             api_key=args.api_key,
             model_id=args.model,
+            max_tokens=args.max_tokens,
             encoding=args.encoding,
         )
     except (OpenAIAPIError, ValueError, json.JSONDecodeError) as exc: